@@ -38,6 +38,7 @@ import sys
 import traceback
 import os
 import logging
+import multiprocessing
 
 from PySide6.QtCore import Qt
 from PySide6.QtWidgets import QApplication, QMessageBox
@@ -96,6 +97,7 @@ sys.excepthook = log_except_hook
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # needed by the sample generation worker processes in frozen builds
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)  # enable highdpi scaling
     QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)  # use highdpi icons
     app = QApplication(sys.argv)
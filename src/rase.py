@@ -57,6 +57,7 @@ from src.detector_dialog import DetectorDialog
 from src.rase_functions import *
 from src.rase_functions import _getCountsDoseAndSensitivity, secondary_type
 from src.progressbar_dialog import ProgressBar
+from src.sample_generation import generate_sample_spectra, generate_sample_spectra_parallel
 from src.rase_settings import RaseSettings, APPLICATION_PATH
 from src.replay_dialog import ReplayDialog
 from src.scenario_dialog import ScenarioDialog
@@ -2039,141 +2040,60 @@ class SampleSpectraGeneration(QObject):
         else:
             self.sampleDir = os.path.join(samplepath, 'SampledSpectra')
         self.sampling_algo = self.settings.getSamplingAlgo()
+        self.workers = 1 if test else self.settings.getSampleGenerationWorkers()
         self.test = test
+        self.count = 0
         self.__abort = False
 
     @Slot()
     def work(self):
-        count = 0
+        self.count = 0
 
         session = Session()
+        work_units = []
         for detName, scenId in self.detector_scenarios:
             detector = session.query(Detector).filter_by(name=detName).first()
-            sample_dir = get_sample_dir(self.sampleDir, detector, scenId)
-            replay_input_dir = get_replay_input_dir(self.sampleDir, detector, scenId)
             scenario = session.query(Scenario).filter_by(id=scenId).first()
 
             if (detector.includeSecondarySpectrum and detector.secondary_type == secondary_type['scenario'] and not scenario.scen_bckg_materials):
                 continue
 
-            os.makedirs(sample_dir, exist_ok=True)
-            os.makedirs(replay_input_dir, exist_ok=True)
-
             # generate seed in order to later recreate sampleSpectra
             if (self.settings.getRandomSeed() != self.settings.getRandomSeedDefault()):
                 seed = self.settings.getRandomSeed()
             else:
-                seed = np.random.randint(0, pow(2, 30))
+                seed = int(np.random.default_rng().integers(0, pow(2, 30)))
             sampleSeed = session.query(SampleSpectraSeed).filter_by(scen_id=scenario.id,
                                                                     det_name=detector.name).first() or \
                          SampleSpectraSeed(scen_id=scenario.id, det_name=detector.name)
             sampleSeed.seed = seed
             session.add(sampleSeed)
             session.commit()
+            work_units.append((detName, scenId, seed))
 
-            countsDoseAndSensitivity = _getCountsDoseAndSensitivity(scenario, detector)
-
-            # Set appropriate secondary spectrum if needed
-            # ???: if present, should distorsions be applied to the secondary background? <SS>
-            secondary_spectrum = None
-            secondary_is_float = False
-            if detector.includeSecondarySpectrum:
-                secondary_spectrum = (session.query(BackgroundSpectrum).filter_by(detector_name=detector.name)).first()
-
-                if detector.secondary_type == secondary_type['scenario']:  # utilize background defined in the scenario for secondary background
-                    secondary_spectrum = BackgroundSpectrum()
-                    spec_info = []
-                    for background, spectrum in product(scenario.scen_bckg_materials, detector.base_spectra):
-                        if background.material_name == spectrum.material_name:
-                            cnts = spectrum.get_counts_as_np()
-                            secondary_is_float = secondary_is_float or not all([float(k) == int(k) for k in cnts])
-                            sens = spectrum.rase_sensitivity if background.fd_mode == 'DOSE' else spectrum.flux_sensitivity
-                            spec_info.append({'counts': cnts, 'livetime': spectrum.livetime, 'realtime': spectrum.realtime,
-                                              'sens': sens, 'bkg_dose': background.dose})
-
-                    secondary_spectrum.livetime = spec_info[0]['livetime']
-                    secondary_spectrum.realtime = spec_info[0]['realtime']
-                    for s in spec_info:
-                        if s['livetime'] > secondary_spectrum.livetime:
-                            secondary_spectrum.livetime = s['livetime']
-                            secondary_spectrum.realtime = s['realtime']
-                    # use maximum livetime of scenario bgnd specs unless bckg_spectra_dwell is specified
-                    if detector.bckg_spectra_dwell != 0:
-                        secondary_spectrum.realtime = detector.bckg_spectra_dwell * (secondary_spectrum.realtime /
-                                                                                     secondary_spectrum.livetime)
-                        secondary_spectrum.livetime = detector.bckg_spectra_dwell
-                    secondary_spectrum.counts = np.zeros(len(spec_info[0]['counts']))
-                    for s in spec_info:
-                        secondary_spectrum.counts += secondary_spectrum.livetime * s['sens'] * s['bkg_dose'] * \
-                                                        (s['counts'] / np.sum(s['counts']))
-                else:
-                    secondary_is_float = not all([float(k) == int(k) for k in secondary_spectrum.counts])
-                    if detector.bckg_spectra_dwell != 0:
-                        secondary_spectrum.counts *= detector.bckg_spectra_dwell / secondary_spectrum.livetime
-                        secondary_spectrum.realtime = detector.bckg_spectra_dwell * (secondary_spectrum.realtime /
-                                                                                     secondary_spectrum.livetime)
-                        secondary_spectrum.livetime = detector.bckg_spectra_dwell
-                if not secondary_is_float:
-                    secondary_spectrum.counts = secondary_spectrum.counts.astype(int)
-            n42_template = None
-            if detector.replay and detector.replay.type == ReplayTypes.standalone and detector.replay.n42_template_path:
-                n42_template = Template(filename=detector.replay.n42_template_path, input_encoding='utf-8')
-
-            # create 'replication' number of files
-            reps = 1 if self.test else scenario.replication
-            for filenum in range(reps):
-                # This is where the downsampling happens
-                if secondary_spectrum and detector.bckg_spectra_resample:
-                    if filenum == 0:
-                        secondary_is_float = secondary_spectrum.is_spectrum_float()
-                        original_secondary_spe_counts = secondary_spectrum.counts
-                    secondary_spectrum.counts = np.random.poisson(original_secondary_spe_counts)
-                    if not secondary_is_float:
-                        secondary_spectrum.counts = secondary_spectrum.counts.astype(int)
-
-                degradations = []
-                for influence in scenario.influences:
-                    influences = session.query(DetectorInfluence).filter_by(influence_name=influence.name).first()
-                    degradations.append([a * (filenum) for a in [influences.degrade_infl0, influences.degrade_infl1,
-                                    influences.degrade_infl2, influences.degrade_f_smear, influences.degrade_l_smear]])
-                    # If there is some degradation, we pass them in to apply degradations without doing it exponentially
-                if not all(v == 0 for deg in degradations for v in deg):
-                    countsDoseAndSensitivity = _getCountsDoseAndSensitivity(scenario, detector, degradations)
-
-                sampleCounts = self.sampling_algo(scenario, detector, countsDoseAndSensitivity, seed + filenum)
-
-                # write out to RASE n42 file
-                fname = os.path.join(sample_dir,
-                                     get_sample_spectra_filename(detector.id, scenario.id, filenum, ".n42"))
-                create_n42_file(fname, scenario, detector, sampleCounts, secondary_spectrum)
-
-                # write out to translated file format
-                if n42_template:
-                    fname = os.path.join(replay_input_dir,
-                                         get_sample_spectra_filename(detector.id, scenario.id, filenum,
-                                                                     detector.replay.input_filename_suffix))
-                    create_n42_file_from_template(n42_template, fname, scenario, detector, sampleCounts,
-                                                  secondary_spectrum)
-
-                count += 1
-                self.sig_step.emit(count)
-
-                # check if we need to abort the loop; need to process events to receive signals;
-                QApplication.processEvents()  # this could cause change to self.__abort
-
-                if self.__abort:
-                    # delete current folders since generation was incomplete
-                    if os.path.exists(sample_dir):
-                        shutil.rmtree(sample_dir)
-                    if os.path.exists(replay_input_dir):
-                        shutil.rmtree(replay_input_dir)
-                    break
+        # the seeds are all drawn here, so that results are the same with or without worker processes
+        if self.workers > 1 and len(work_units) > 1:
+            completed = generate_sample_spectra_parallel(work_units, self.sampleDir, self.sampling_algo,
+                                                         self.workers, self.test, self.step)
+        else:
+            completed = all(generate_sample_spectra(detName, scenId, self.sampleDir, self.sampling_algo, seed,
+                                                    self.test, self.step) for detName, scenId, seed in work_units)
 
         session.close()
-        if self.__abort:
-            self.sig_done.emit(False)
-        else:
-            self.sig_done.emit(True)
+        self.sig_done.emit(completed and not self.__abort)
+
+    def step(self, replications=1):
+        """
+        Reports the number of replications generated since the last call
+        :return: True if the generation must be aborted
+        """
+        if replications:
+            self.count += replications
+            self.sig_step.emit(self.count)
+
+        # check if we need to abort the loop; need to process events to receive signals;
+        QApplication.processEvents()  # this could cause change to self.__abort
+        return self.__abort
 
     def abort(self):
         self.__abort = True
@@ -34,6 +34,7 @@
 This module defines key functions used in RASE
 """
 
+import functools
 import glob
 import io
 import logging
@@ -42,19 +43,25 @@ import os
 import re
 import shutil
 import sys
+import tempfile
 from lxml import etree
 from pathlib import Path
 import isodate, datetime
 import numpy as np
+import scipy.sparse
+import scipy.special
 from mako import exceptions
+from mako.template import Template
 from sqlalchemy.engine import create_engine, Engine
-from sqlalchemy import event
+from sqlalchemy import event, inspect as sql_inspect, text as sql_text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session as OrmSession
 
 from src.scenarios_io import ScenariosIO
 from src.table_def import BaseSpectrum, BackgroundSpectrum, SecondarySpectrum, Detector, Scenario, \
     SampleSpectraSeed, Session, Base, ScenarioMaterial, ScenarioBackgroundMaterial, Material, \
-    DetectorInfluence
-from src.utils import compress_counts, indent
+    DetectorInfluence, Spectrum
+from src.utils import compress_counts, counts_to_bytes, indent
 
 # Key variables used in several places
 secondary_type = {'base_spec': 0, 'scenario': 1, 'file': 2}
@@ -72,9 +79,44 @@ def initializeDatabase(databaseFilepath):
     if not os.path.exists(databaseFilepath):
         Base.metadata.create_all(engine)
         return False
+    migrate_spectra_counts(engine)
     return True
 
 
+def migrate_spectra_counts(engine, chunk_size=1000):
+    """
+    Converts the spectra counts of databases created before counts were stored as binary arrays.
+    The text column is emptied (or dropped, when the SQLite version allows it) and the database compacted.
+
+    :param engine: engine bound to the database
+    :param chunk_size: number of spectra converted at once
+    """
+    inspector = sql_inspect(engine)
+    if not inspector.has_table('spectra'):
+        return
+    columns = [c['name'] for c in inspector.get_columns('spectra')]
+    if 'baseCounts' not in columns:
+        return
+    logging.info('Converting spectra counts to binary storage')
+    with engine.begin() as connection:
+        if 'counts_blob' not in columns:
+            connection.execute(sql_text('ALTER TABLE spectra ADD COLUMN counts_blob BLOB'))
+        while True:
+            rows = connection.execute(sql_text('SELECT id, baseCounts FROM spectra WHERE baseCounts IS NOT NULL '
+                                               'LIMIT :n'), {'n': chunk_size}).fetchall()
+            if not rows:
+                break
+            connection.execute(sql_text('UPDATE spectra SET counts_blob = :blob, baseCounts = NULL WHERE id = :id'),
+                               [{'id': row.id, 'blob': counts_to_bytes(np.array(row.baseCounts.split(','), dtype=float))
+                                 if row.baseCounts else None} for row in rows])
+        try:
+            connection.execute(sql_text('ALTER TABLE spectra DROP COLUMN baseCounts'))
+        except OperationalError:
+            pass  # SQLite older than 3.35, the emptied column is left in place
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT').execute(sql_text('VACUUM'))
+
+
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
@@ -351,56 +393,76 @@ def getSeconds(text):
 def rebin(counts, oldEnergies, newEcal):
     """
     Rebins a list ouf counts to a new energy calibration.
+    Counts are assumed to be uniformly distributed within each old bin, and are redistributed
+    according to the overlap of old and new bins using the cumulative sum of the counts.
 
     :param counts:      numpy array ouf counts indexed by channel
     :param oldEnergies: numpy array of energies indexed by channel
     :param newEcal:     list of new energy polynomial coefficents to rebin to: [E3 E2 E1 E0]
     :return:            numpy array of rebinned counts
     """
-    newEnergies = np.polyval(np.flip(newEcal), np.arange(len(counts)+1))
-    newCounts   = np.zeros(len(counts))
+    counts = np.asarray(counts, dtype=float)
+    newEnergies = np.polyval(np.flip(newEcal), np.arange(len(counts) + 1))
+    oldEdges = _monotonic_edges(oldEnergies)
 
-    # move old energies index to first value greater than the first value in newEnergies
-    oe = 0 # will always lead ne in energy boundary value
-    while oe < len(oldEnergies) and oldEnergies[oe] <= newEnergies[0]: oe += 1
-    ne0 = 0
-    while newEnergies[ne0] <= oldEnergies[oe]:
-        ne0 += 1
+    # only channels with both an upper and a lower energy boundary are distributed
+    oldIntegral = np.concatenate(([0.], np.cumsum(counts[:len(oldEdges) - 1])))
+    newIntegral = np.interp(_monotonic_edges(newEnergies), oldEdges, oldIntegral)
+    return np.diff(newIntegral)
 
-    # loop through and distribute old counts into new bins
-    for ne in range(ne0, len(newCounts)):
-        if oe == len(oldEnergies): break  # have already distributed all old counts
 
-        # if no old energy boundaries within this new bin, new bin is fraction of old bin
-        if oldEnergies[oe] > newEnergies[ne + 1]:
-            newCounts[ne] = counts[oe - 1] * (newEnergies[ne + 1] - newEnergies[ne]) \
-                            / (oldEnergies[oe] - oldEnergies[oe - 1])
-
-        # else there are old energy boundaries in this new bin: add each portion of old bins
-        else:
-            # Step 1: add first partial(or full) old bin
-            # TODO: This will crash if (oldEnergies[oe] - oldEnergies[oe-1]) < 0; might be necessary to handle this?
-            newCounts[ne] = counts[oe-1] * (oldEnergies[oe] - newEnergies[ne]) \
-                            / (oldEnergies[oe] - oldEnergies[oe-1])
-            oe += 1
-
-            # Step 2: add middle full old bins
-            while oe < len(oldEnergies) and oldEnergies[oe] <= newEnergies[ne+1]:
-                newCounts[ne] += counts[oe-1]
-                oe += 1
-            if oe == len(oldEnergies): break
-
-            # Step 3: add last partial old bin
-            newCounts[ne] += counts[oe-1] * (newEnergies[ne+1] - oldEnergies[oe-1]) \
-                             / (oldEnergies[oe] - oldEnergies[oe-1])
-    return newCounts
+@functools.lru_cache(maxsize=64)
+def rebin_matrix(oldEcal, newEcal, chan_count):
+    """
+    Sparse linear operator rebinning spectra from one energy calibration to another.
+    rebin_matrix(oldEcal, newEcal, n) @ counts gives the same result as
+    rebin(counts, np.polyval(np.flip(oldEcal), np.arange(n)), newEcal), and can be applied to several spectra at once.
+    Matrices are cached for each set of arguments.
+
+    :param oldEcal:    tuple of energy polynomial coefficients of the spectra
+    :param newEcal:    tuple of energy polynomial coefficents to rebin to
+    :param chan_count: number of channels
+    :return:           scipy.sparse.csr_matrix of shape (chan_count, chan_count)
+    """
+    oldEdges = _monotonic_edges(np.polyval(np.flip(oldEcal), np.arange(chan_count)))
+    newEdges = _monotonic_edges(np.polyval(np.flip(newEcal), np.arange(chan_count + 1)))
+
+    # range of old bins overlapping each new bin
+    first = np.clip(np.searchsorted(oldEdges, newEdges[:-1], side='right') - 1, 0, len(oldEdges) - 2)
+    last = np.clip(np.searchsorted(oldEdges, newEdges[1:], side='left') - 1, 0, len(oldEdges) - 2)
+    n_overlaps = np.maximum(last - first + 1, 0)
+    rows = np.repeat(np.arange(chan_count), n_overlaps)
+    cols = np.arange(n_overlaps.sum()) - np.repeat(np.cumsum(n_overlaps) - n_overlaps, n_overlaps) \
+        + np.repeat(first, n_overlaps)
+
+    # fraction of each old bin that falls within the new bin
+    lower = np.maximum(newEdges[rows], oldEdges[cols])
+    upper = np.minimum(newEdges[rows + 1], oldEdges[cols + 1])
+    width = oldEdges[cols + 1] - oldEdges[cols]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fractions = np.where(width > 0, np.clip(upper - lower, 0, None) / width, 0)
+    # counts of zero-width old bins go to the new bin that contains them
+    point = (width == 0) & (newEdges[rows] <= oldEdges[cols]) & (oldEdges[cols] < newEdges[rows + 1])
+    fractions[point] = 1
+
+    keep = fractions > 0
+    return scipy.sparse.csr_matrix((fractions[keep], (rows[keep], cols[keep])), shape=(chan_count, chan_count))
+
+
+def _monotonic_edges(energies):
+    """
+    Bin edges made non-decreasing: where a calibration is not increasing, bins are given zero width
+    """
+    return np.maximum.accumulate(np.asarray(energies, dtype=float))
 
 
-def _getCountsDoseAndSensitivity(scenario, detector, degradations=None):
+def _getCountsDoseAndSensitivity(scenario, detector, degradations=None, rng=None):
     """
 
     :param scenario:
     :param detector:
+    :param degradations:
+    :param rng: np.random.Generator used to smear the spectra when influences are applied
     :return:
     """
     session = Session()
@@ -425,23 +487,19 @@ def _getCountsDoseAndSensitivity(scenario, detector, degradations=None):
     # get dose, counts and sensitivity for each material
     countsDoseAndSensitivity = []
     for scenMaterial in scenario.scen_materials + scenario.scen_bckg_materials:
-        baseSpectrum = (session.query(BaseSpectrum)
-                        .filter_by(detector_name=detector.name,
-                                   material_name=scenMaterial.material_name)
-                        ).first()
-        counts = baseSpectrum.counts
-        if not (np.array_equal(ecal, baseSpectrum.ecal)):
-            oldenergies = np.polyval(np.flip(baseSpectrum.ecal), np.arange(detector.chan_count))
-            counts = rebin(counts, oldenergies, ecal)
+        counts, rase_sensitivity, flux_sensitivity = _get_base_counts(detector.name, scenMaterial.material_name,
+                                                                      tuple(ecal), detector.chan_count)
+        counts = np.array(counts)
 
+        # smearing is random, so influences are applied to a copy of the cached counts for each scenario
         if scenario.influences:
             for index, infl in enumerate(new_influences):
-                counts = apply_distortions(infl, counts, bin_widths[index], energies, ecal)
+                counts = apply_distortions(infl, counts, bin_widths[index], energies, ecal, rng)
 
         if scenMaterial.fd_mode == 'FLUX':
-            countsDoseAndSensitivity.append((counts, scenMaterial.dose, baseSpectrum.flux_sensitivity))
+            countsDoseAndSensitivity.append((counts, scenMaterial.dose, flux_sensitivity))
         else:
-            countsDoseAndSensitivity.append((counts, scenMaterial.dose, baseSpectrum.rase_sensitivity))
+            countsDoseAndSensitivity.append((counts, scenMaterial.dose, rase_sensitivity))
 
     # if the detector has an internal calibration source, it needs to be added with special treatment
     if detector.includeSecondarySpectrum and detector.sample_intrinsic:
@@ -454,7 +512,7 @@ def _getCountsDoseAndSensitivity(scenario, detector, degradations=None):
         # apply distortion on counts
         if scenario.influences:
             for index, infl in enumerate(new_influences):
-                counts = apply_distortions(infl, counts, bin_widths[index], energies, ecal)
+                counts = apply_distortions(infl, counts, bin_widths[index], energies, ecal, rng)
 
         # extract counts per second
         cps = sum(counts)/secondary_spectrum.livetime
@@ -466,6 +524,45 @@ def _getCountsDoseAndSensitivity(scenario, detector, degradations=None):
     return countsDoseAndSensitivity
 
 
+# maximum number of rebinned base spectra kept in memory by _get_base_counts()
+BASE_COUNTS_CACHE_SIZE = 512
+
+
+@functools.lru_cache(maxsize=BASE_COUNTS_CACHE_SIZE)
+def _get_base_counts(detector_name, material_name, ecal, chan_count):
+    """
+    Returns the counts of a base spectrum rebinned to the given energy calibration, with its sensitivities.
+    Results are cached, and the cache is cleared whenever spectra are modified in the database.
+
+    :param detector_name:
+    :param material_name:
+    :param ecal: tuple of energy calibration coefficients of the sample spectra
+    :param chan_count: number of channels of the detector
+    :return: read-only counts array, rase sensitivity, flux sensitivity
+    """
+    baseSpectrum = (Session().query(BaseSpectrum)
+                    .filter_by(detector_name=detector_name, material_name=material_name)).first()
+    counts = baseSpectrum.counts
+    if not (np.array_equal(ecal, baseSpectrum.ecal)):
+        counts = rebin_matrix(tuple(baseSpectrum.ecal), ecal, chan_count) @ counts
+    counts.setflags(write=False)
+    return counts, baseSpectrum.rase_sensitivity, baseSpectrum.flux_sensitivity
+
+
+@event.listens_for(Spectrum, "after_insert", propagate=True)
+@event.listens_for(Spectrum, "after_update", propagate=True)
+@event.listens_for(Spectrum, "after_delete", propagate=True)
+def _spectrum_changed(mapper, connection, target):
+    _get_base_counts.cache_clear()
+
+
+@event.listens_for(OrmSession, "do_orm_execute")
+def _bulk_statement_executed(orm_execute_state):
+    # bulk updates and deletes (e.g. query().delete()) bypass the mapper events above
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        _get_base_counts.cache_clear()
+
+
 def create_n42_file(filename, scenario, detector, sample_counts, secondary_spectrum=None):
     """
     Creates n42 file from input
@@ -475,54 +572,102 @@ def create_n42_file(filename, scenario, detector, sample_counts, secondary_spect
     :param sample_counts: sample counts array
     :param secondary_spectrum: optional secondary spectrum array
     """
-    # FIXME: should use ElementTree instead of manually creating the XML text
-    f = open(filename, 'w')
-    f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    f.write('<N42InstrumentData>\n')
-    f.write('  <Measurement>\n')
-    f.write('    <Spectrum>\n')
-    f.write('      <SourceType>Item</SourceType>\n')
-    f.write('      <MeasurementClassCode>Foreground</MeasurementClassCode>\n')
-    f.write('      <RealTime Unit="sec">PT{}S</RealTime>\n'.format(scenario.acq_time))
-    f.write('      <LiveTime Unit="sec">PT{}S</LiveTime>\n'.format(scenario.acq_time))
-    f.write('      <Calibration Type="Energy" EnergyUnits="keV">\n')
-    f.write('        <Equation Model="Polynomial">\n')
-    f.write('          <Coefficients>{} {} {} {}</Coefficients>\n'.format(detector.ecal0, detector.ecal1, detector.ecal2, detector.ecal3))
-    f.write('        </Equation>\n')
-    f.write('      </Calibration>\n')
-    f.write('      <ChannelData>')
-    if all([float(k) == int(k) for k in sample_counts]):
-        f.write('{}'.format(' '.join('{:d}'.format(x) for x in sample_counts)))
-    else:
-        f.write('{}'.format(' '.join('{:f}'.format(x) for x in sample_counts)))
-    f.write('</ChannelData>\n')
-    f.write('    </Spectrum>\n')
-    if secondary_spectrum:
-        if (detector.secondary_type == secondary_type['scenario']):
-            type_str = 'Background'
-        elif (detector.sample_intrinsic and len(detector.secondary_spectra) == 1) or \
-                detector.secondary_classcode == 'Calibration':
-            type_str = 'Calibration'
-        else:
-            type_str = detector.secondary_classcode #'Background'
-        f.write('    <Spectrum>\n')
-        f.write(f'      <MeasurementClassCode>{type_str}</MeasurementClassCode>\n')
-        f.write('      <RealTime Unit="sec">PT{}S</RealTime>\n'.format(secondary_spectrum.realtime))
-        f.write('      <LiveTime Unit="sec">PT{}S</LiveTime>\n'.format(secondary_spectrum.livetime))
-        f.write('      <Calibration Type="Energy" EnergyUnits="keV">\n')
-        f.write('        <Equation Model="Polynomial">\n')
-        f.write('          <Coefficients>{} {} {} {}</Coefficients>\n'.format(detector.ecal0, detector.ecal1,
-                                                                              detector.ecal2, detector.ecal3))
-        f.write('        </Equation>\n')
-        f.write('      </Calibration>\n')
-        f.write('      <ChannelData>')
-        f.write(secondary_spectrum.get_counts_as_str())
-
-        f.write('</ChannelData>\n')
-        f.write('    </Spectrum>\n')
-    f.write('  </Measurement>\n')
-    f.write('</N42InstrumentData>\n')
-    f.close()
+    N42Writer(scenario, detector, secondary_spectrum).write(filename, sample_counts)
+
+
+class N42Writer:
+    """
+    Writes the RASE n42 files of the replications of a detector/scenario pair.
+    The parts of the files that are the same for all replications are rendered only once,
+    and each file is written with a single call.
+    """
+
+    def __init__(self, scenario, detector, secondary_spectrum=None, compressed=False):
+        """
+        :param scenario: scenario info
+        :param detector: detector info
+        :param secondary_spectrum: optional secondary spectrum
+        :param compressed: if True, channel data is written with the CountedZeroes compression
+        """
+        # FIXME: should use ElementTree instead of manually creating the XML text
+        self.compressed = compressed
+        channel_data = '      <ChannelData compressionCode="CountedZeroes">' if compressed else '      <ChannelData>'
+        calibration = ('      <Calibration Type="Energy" EnergyUnits="keV">\n'
+                       '        <Equation Model="Polynomial">\n'
+                       '          <Coefficients>{} {} {} {}</Coefficients>\n'
+                       '        </Equation>\n'
+                       '      </Calibration>\n').format(detector.ecal0, detector.ecal1, detector.ecal2, detector.ecal3)
+
+        self.header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<N42InstrumentData>\n'
+                       '  <Measurement>\n'
+                       '    <Spectrum>\n'
+                       '      <SourceType>Item</SourceType>\n'
+                       '      <MeasurementClassCode>Foreground</MeasurementClassCode>\n'
+                       '      <RealTime Unit="sec">PT{}S</RealTime>\n'
+                       '      <LiveTime Unit="sec">PT{}S</LiveTime>\n'.format(scenario.acq_time, scenario.acq_time) +
+                       calibration + channel_data)
+        self.footer = '</ChannelData>\n    </Spectrum>\n  </Measurement>\n</N42InstrumentData>\n'
+
+        self.secondary_header = None
+        self.secondary_counts = ''
+        if secondary_spectrum:
+            if (detector.secondary_type == secondary_type['scenario']):
+                type_str = 'Background'
+            elif (detector.sample_intrinsic and len(detector.secondary_spectra) == 1) or \
+                    detector.secondary_classcode == 'Calibration':
+                type_str = 'Calibration'
+            else:
+                type_str = detector.secondary_classcode #'Background'
+            self.secondary_header = ('</ChannelData>\n'
+                                     '    </Spectrum>\n'
+                                     '    <Spectrum>\n'
+                                     f'      <MeasurementClassCode>{type_str}</MeasurementClassCode>\n'
+                                     '      <RealTime Unit="sec">PT{}S</RealTime>\n'
+                                     '      <LiveTime Unit="sec">PT{}S</LiveTime>\n'.format(secondary_spectrum.realtime,
+                                                                                         secondary_spectrum.livetime) +
+                                     calibration + channel_data)
+            self.secondary_counts = self._secondary_counts_as_str(secondary_spectrum.get_counts_as_np())
+
+    def write(self, filename, sample_counts, secondary_counts=None):
+        """
+        Writes one n42 file
+        :param filename: path of resultant n42 file
+        :param sample_counts: sample counts array
+        :param secondary_counts: optional counts replacing those of the secondary spectrum given at creation,
+                                 e.g. when the secondary spectrum is resampled for each replication
+        """
+        parts = [self.header, self._counts_as_str(sample_counts)]
+        if self.secondary_header is not None:
+            parts.append(self.secondary_header)
+            if secondary_counts is None:
+                parts.append(self.secondary_counts)
+            else:
+                parts.append(self._secondary_counts_as_str(secondary_counts))
+        parts.append(self.footer)
+        with open(filename, 'w') as f:
+            f.write(''.join(parts))
+
+    def _counts_as_str(self, counts):
+        counts = np.asarray(counts)
+        if np.issubdtype(counts.dtype, np.integer) or np.all(np.mod(counts, 1) == 0):
+            counts = counts.astype(int)
+            if self.compressed:
+                counts = compress_counts(counts)
+            return ' '.join(map(str, counts.tolist()))
+        if self.compressed:
+            counts = compress_counts(counts)
+        return ' '.join(map('{:f}'.format, counts.tolist()))
+
+    def _secondary_counts_as_str(self, counts):
+        # same format as Spectrum.get_counts_as_str() and Spectrum.get_compressed_counts_as_str()
+        counts = np.asarray(counts, dtype=float)
+        is_float = np.any((counts != 0) & ((counts < 1) | (np.mod(counts, 1) != 0)))
+        if self.compressed:
+            return self._counts_as_str(counts if is_float else counts.astype(int))
+        if is_float:
+            return ' '.join(map(str, counts.tolist()))
+        return ' '.join(map(str, counts.astype(int).tolist()))
 
 
 def create_n42_file_from_template(n42_mako_template, filename, scenario, detector, sample_counts : np.ndarray, secondary_spectrum=None):
@@ -535,35 +680,111 @@ def create_n42_file_from_template(n42_mako_template, filename, scenario, detecto
     :param sample_counts: sample counts array
     :param secondary_spectrum: optional secondary spectrum array
     """
-    template_data = dict(
-        scenario=scenario,
-        detector=detector,
-        # TODO: we may want to create a 'sample_counts' class with methods to return it in different formatting
+    N42TemplateRenderer(n42_mako_template, scenario, detector, secondary_spectrum).write(filename, sample_counts)
 
-    )
-    try:
-        template_data['sample_counts'] = ' '.join('{:d}'.format(x) for x in sample_counts)
-        template_data['compressed_sample_counts'] = ' '.join('{:d}'.format(x) for x in compress_counts(sample_counts))
-        template_data['sample_counts_array'] = sample_counts
-        template_data['bin_edges'] = ' '.join(str(v) for v in np.polyval([detector.ecal3, detector.ecal2, detector.ecal1, detector.ecal0], np.arange(detector.chan_count+1)))
-    except TypeError:
-        template_data['sample_periods'] = sample_counts
 
-    if secondary_spectrum:
-        secondary_spectrum.counts = secondary_spectrum.counts.astype(int)
-        template_data.update(dict(secondary_spectrum=secondary_spectrum))
+# directory where the python modules compiled from the n42 templates are kept between sessions
+N42_TEMPLATE_MODULE_DIR = os.path.join(tempfile.gettempdir(), 'rase_n42_templates')
 
-    try:
-        templated_content = n42_mako_template.render(**template_data)
-    except:
-        logging.info("Mako Template exception:")
-        err_msg = exceptions.text_error_template().render()
-        logging.info(err_msg)
-        print(err_msg)
-        raise
 
-    with open(filename, 'w', newline='') as f:
-        f.write(templated_content)
+def get_n42_template(template_path):
+    """
+    Returns the compiled mako template of an n42 template file.
+    Templates are compiled once per session, and the compiled modules are kept on disk
+    so that other processes and later sessions load them without recompiling.
+
+    :param template_path: path of the n42 template file
+    :return: mako Template
+    """
+    template_path = os.path.abspath(template_path)
+    return _get_n42_template(template_path, os.path.getmtime(template_path))
+
+
+@functools.lru_cache(maxsize=32)
+def _get_n42_template(template_path, mtime):
+    return Template(filename=template_path, input_encoding='utf-8', module_directory=N42_TEMPLATE_MODULE_DIR)
+
+
+def _template_identifiers(n42_mako_template):
+    """
+    Names of the context variables used by a template, or None if they cannot be determined
+    """
+    code = n42_mako_template.code
+    # templates accessing the context directly may use any variable
+    if re.search(r'\bcontext\.(get|kwargs|keys)\b|\bpageargs\b', n42_mako_template.source or ''):
+        return None
+    # the compiled template fetches each of the variables it uses from the context
+    return set(re.findall(r"context\.get\('(\w+)', UNDEFINED\)", code))
+
+
+class N42TemplateRenderer:
+    """
+    Writes the replications of a detector/scenario pair with an n42 mako template.
+    Only the variables used by the template are computed for each replication,
+    and those that are the same for all replications are computed only once.
+    """
+
+    def __init__(self, n42_mako_template, scenario, detector, secondary_spectrum=None):
+        """
+        :param n42_mako_template: template used to make files
+        :param scenario: scenario info
+        :param detector: detector info
+        :param secondary_spectrum: optional secondary spectrum
+        """
+        self.template = n42_mako_template
+        self.detector = detector
+        self.identifiers = _template_identifiers(n42_mako_template)
+        self.template_data = dict(scenario=scenario, detector=detector)
+        if self._uses('bin_edges'):
+            self.template_data['bin_edges'] = ' '.join(str(v) for v in np.polyval(
+                [detector.ecal3, detector.ecal2, detector.ecal1, detector.ecal0], np.arange(detector.chan_count+1)))
+        self.secondary_spectrum = secondary_spectrum
+        if secondary_spectrum:
+            secondary_spectrum.counts = secondary_spectrum.counts.astype(int)
+            self.template_data['secondary_spectrum'] = secondary_spectrum
+
+    def _uses(self, name):
+        return self.identifiers is None or name in self.identifiers
+
+    def write(self, filename, sample_counts, secondary_counts=None):
+        """
+        Writes one file
+        :param filename: path of resultant file
+        :param sample_counts: sample counts array
+        :param secondary_counts: optional counts replacing those of the secondary spectrum given at creation,
+                                 e.g. when the secondary spectrum is resampled for each replication
+        """
+        template_data = dict(self.template_data)
+        if isinstance(sample_counts, np.ndarray) and np.issubdtype(sample_counts.dtype, np.integer):
+            if self._uses('sample_counts'):
+                template_data['sample_counts'] = ' '.join(map(str, sample_counts.tolist()))
+            if self._uses('compressed_sample_counts'):
+                template_data['compressed_sample_counts'] = ' '.join(map(str, compress_counts(sample_counts).tolist()))
+            template_data['sample_counts_array'] = sample_counts
+        else:
+            # TODO: we may want to create a 'sample_counts' class with methods to return it in different formatting
+            try:
+                template_data['sample_counts'] = ' '.join('{:d}'.format(x) for x in sample_counts)
+                template_data['compressed_sample_counts'] = ' '.join('{:d}'.format(x) for x in compress_counts(sample_counts))
+                template_data['sample_counts_array'] = sample_counts
+            except TypeError:
+                template_data.pop('bin_edges', None)
+                template_data['sample_periods'] = sample_counts
+
+        if self.secondary_spectrum and secondary_counts is not None:
+            self.secondary_spectrum.counts = np.asarray(secondary_counts).astype(int)
+
+        try:
+            templated_content = self.template.render(**template_data)
+        except:
+            logging.info("Mako Template exception:")
+            err_msg = exceptions.text_error_template().render()
+            logging.info(err_msg)
+            print(err_msg)
+            raise
+
+        with open(filename, 'w', newline='') as f:
+            f.write(templated_content)
 
 
 def write_results(results_array, out_filepath):
@@ -778,21 +999,18 @@ def files_exist(directory, globadd='/*'):
     return False
 
 
-def apply_distortions(new_influences, counts, bin_widths, energies, ecal):
-    count_bs = BaseSpectrum()
+def apply_distortions(new_influences, counts, bin_widths, energies, ecal, rng=None):
     if (not new_influences[0] == 0) or (not new_influences[2] == 0) or (not new_influences[1] == 1):
         counts = rebin(np.array(counts), energies, ecal)
-    count_bs.counts = counts
-    counts = gaussian_smearing(counts, bin_widths, new_influences[4], count_bs.is_spectrum_float())
+    counts = np.asarray(counts)
+    # same criterion as Spectrum.is_spectrum_float()
+    is_float = bool(np.any((counts != 0) & ((counts < 1) | (counts % 1 != 0))))
+    counts = gaussian_smearing(counts, bin_widths, new_influences[4], is_float, rng)
     return counts
 
 
 def calculate_influence(scenario, detector, degradations, ecal):
-    session = Session()
-
-    energies = np.polyval(np.flip(ecal), np.arange(detector.chan_count))
     new_influences = []
-    bin_widths = np.zeros([len(scenario.influences), len(energies)])
     for index, influence in enumerate(scenario.influences):
         detInfl = influence.detector_influence
         new_infl = [detInfl.infl_0, detInfl.infl_1, detInfl.infl_2, detInfl.fixed_smear, detInfl.linear_smear]
@@ -808,44 +1026,155 @@ def calculate_influence(scenario, detector, degradations, ecal):
 
         new_influences.append(new_infl)
 
+    bin_widths, energies = _influence_bin_widths_and_energies(tuple(float(e) for e in ecal), detector.chan_count,
+                                                              tuple(tuple(infl) for infl in new_influences))
+    return new_influences, bin_widths, energies
+
+
+@functools.lru_cache(maxsize=256)
+def _influence_bin_widths_and_energies(ecal, chan_count, new_influences):
+    """
+    Distorted channel energies and fixed smearing widths of each influence.
+    Results are cached and returned as read-only arrays.
+
+    :param ecal: tuple of energy calibration coefficients
+    :param chan_count: number of channels
+    :param new_influences: tuple of (infl_0, infl_1, infl_2, fixed_smear, linear_smear) for each influence
+    :return: bin widths of shape (influences, channels), energies of each channel
+    """
+    energies = np.polyval(np.flip(ecal), np.arange(chan_count))
+    bin_widths = np.zeros([len(new_influences), len(energies)])
+    for index, new_infl in enumerate(new_influences):
         if new_infl[0] != 0 or new_infl[2] != 0 or new_infl[1] != 1:
             energies = np.polyval([new_infl[2], (new_infl[1]), new_infl[0]], energies)
         # convert fixed energy smear distortion from energy to bins
         if new_infl[3] != 0:
             e_width = new_infl[3] / 2
-            for sub_index, energy in enumerate(energies):
-                b0 = np.roots([new_infl[2], new_infl[1], new_infl[0] - (energy - e_width)])
-                b1 = np.roots([new_infl[2], new_infl[1], new_infl[0] - (energy + e_width)])
-                bin_widths[index][sub_index] = max(b1) - max(b0)
-    return new_influences, bin_widths, energies
+            bin_widths[index] = _max_quadratic_root(new_infl[2], new_infl[1], new_infl[0] - (energies + e_width)) - \
+                _max_quadratic_root(new_infl[2], new_infl[1], new_infl[0] - (energies - e_width))
+    energies.setflags(write=False)
+    bin_widths.setflags(write=False)
+    return bin_widths, energies
 
 
-def gaussian_smearing(orig_hist, bin_widths, res_percent, is_float=False):
-    #TODO: Temp fix to make gaussian smearing fast by forcing integers in influence scenarios
-    is_float = False
+def _max_quadratic_root(a, b, c):
+    """
+    Largest root of a * x**2 + b * x + c for an array of constant terms c, with the same conventions as
+    max(np.roots([a, b, c])): the real part is returned for complex roots, and the polynomial is reduced to
+    a linear one when a is zero. Degenerate constant polynomials have no root, and zero is returned.
+    """
+    c = np.asarray(c, dtype=float)
+    if a == 0:
+        if b == 0:
+            return np.zeros_like(c)
+        return -c / b
+
+    discriminant = b * b - 4 * a * c
+    sqrt_discriminant = np.sqrt(np.maximum(discriminant, 0))
+    # numerically stable form: the roots are q / a and c / q
+    q = -0.5 * (b + np.copysign(sqrt_discriminant, b))
+    root_1 = q / a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root_2 = np.where(q != 0, c / np.where(q != 0, q, 1), root_1)
+    # complex conjugate roots share their real part
+    return np.where(discriminant < 0, -b / (2 * a), np.maximum(root_1, root_2))
+
+
+def gaussian_smearing(orig_hist, bin_widths, res_percent, is_float=False, rng=None):
+    """
+    Smears a spectrum with a gaussian of width bin_widths[i] + sigma * i (in channels) centered on each channel i,
+    where sigma is derived from the resolution res_percent.
+    Integer spectra are redistributed count by count (multinomial sampling), while floating point spectra are
+    replaced by their expected smeared values.
+
+    :param orig_hist: counts indexed by channel
+    :param bin_widths: fixed smearing width of each channel, in channels
+    :param res_percent: linear smearing resolution, in percent FWHM
+    :param is_float: True if the spectrum holds non-integer values
+    :param rng: seed or np.random.Generator used for integer spectra
+    :return: smeared counts
+    """
+    kernel = smearing_matrix(bin_widths, res_percent)
     if is_float:
-        order_of_mag_list = [round(np.log10(v)) for v in orig_hist if v > 0]  # to prevent scaling values to large
-                                                                              # values that make sampling take forever
-        if min(order_of_mag_list) < 0:
-            oom_scale = int(np.power(10, (min(order_of_mag_list) + 1) * -1))
-        else:
-            oom_scale = int(np.power(10, max((4 - max(order_of_mag_list)), 0)))
-        hist = np.array(orig_hist * oom_scale).astype(int)
-    else:
-        hist = orig_hist  # expect counts, so casting into int
+        return kernel @ np.asarray(orig_hist, dtype=float)
+
+    rng = np.random.default_rng(rng)
+    hist = np.asarray(orig_hist).astype(int)
+    hist[hist < 0] = 0
+    # both methods are exact; drawing each count is faster when there are few counts compared to the kernel size
+    if hist.sum() < 2 * kernel.nnz:
+        widths = np.asarray(bin_widths) + (res_percent / 100) / 2.355 * np.arange(len(hist))
+        channels = np.repeat(np.arange(len(hist)), hist)
+        smeared = np.floor(rng.normal(channels, widths[channels])).astype(int)
+        return np.bincount(smeared[(smeared >= 0) & (smeared < len(hist))], minlength=len(hist))
+    return _multinomial_smearing(hist, kernel, rng)
+
+
+# number of standard deviations beyond which the smearing kernel is truncated
+SMEARING_KERNEL_WIDTH = 5
+
+
+def smearing_matrix(bin_widths, res_percent):
+    """
+    Sparse matrix whose column i is the probability for a count in channel i to be smeared into each channel.
+    Probability smeared outside of the spectrum is lost. Matrices are cached for each set of arguments.
+
+    :param bin_widths: fixed smearing width of each channel, in channels
+    :param res_percent: linear smearing resolution, in percent FWHM
+    :return: scipy.sparse.csc_matrix of shape (channels, channels)
+    """
+    bin_widths = np.ascontiguousarray(bin_widths, dtype=float)
+    return _smearing_matrix(bin_widths.tobytes(), float(res_percent))
+
+
+@functools.lru_cache(maxsize=32)
+def _smearing_matrix(bin_widths_bytes, res_percent):
+    bin_widths = np.frombuffer(bin_widths_bytes)
+    n = len(bin_widths)
     sigma = (res_percent / 100) / 2.355
+    widths = bin_widths + sigma * np.arange(n)
 
-    # gaussian smearing
-    a = [np.random.normal(i, b + sigma * i, int(k)) for i, (b, k) in enumerate(zip(bin_widths, hist))]
-    a = np.concatenate(a)
+    # the channels [i - half_width, i + half_width] are the ones receiving counts from channel i
+    half_width = np.ceil(SMEARING_KERNEL_WIDTH * widths).astype(int) + 1
+    half_width[widths == 0] = 0
+    lengths = 2 * half_width + 1
+    cols = np.repeat(np.arange(n), lengths)
+    rows = cols - np.repeat(half_width, lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,
+                                                                                       lengths)
 
-    # reformat into an histogram
-    smeared_hist, __ = np.histogram(a, bins=np.arange(0, len(orig_hist) + 1))
+    # a count at channel i is distributed as normal(i, width) and histogrammed on the edges [j, j + 1)
+    col_widths = widths[cols]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        upper = scipy.special.ndtr((rows + 1 - cols) / col_widths)
+        lower = scipy.special.ndtr((rows - cols) / col_widths)
+    prob = np.where(col_widths > 0, upper - lower, (rows == cols).astype(float))
+
+    keep = (rows >= 0) & (rows < n) & (prob > 0)
+    return scipy.sparse.csc_matrix((prob[keep], (rows[keep], cols[keep])), shape=(n, n))
 
-    if is_float:
-        smeared_hist = smeared_hist / oom_scale
 
-    return smeared_hist
+def _multinomial_smearing(counts, kernel, rng):
+    """
+    Redistributes the integer counts of each channel among channels according to the columns of the kernel,
+    by drawing conditional binomials channel by channel within each column
+    """
+    n = len(counts)
+    smeared = np.zeros(n, dtype=int)
+    remaining = counts.copy()
+    remaining_prob = np.ones(n)
+    lengths = np.diff(kernel.indptr)
+    for position in range(lengths.max(initial=0)):
+        cols = np.nonzero((lengths > position) & (remaining > 0))[0]
+        if not len(cols):
+            break
+        idx = kernel.indptr[cols] + position
+        prob = kernel.data[idx]
+        fraction = np.clip(prob / np.maximum(remaining_prob[cols], prob), 0, 1)
+        drawn = rng.binomial(remaining[cols], fraction)
+        smeared += np.bincount(kernel.indices[idx], weights=drawn, minlength=n).astype(int)
+        remaining[cols] -= drawn
+        remaining_prob[cols] -= prob
+    return smeared
 
 
 def get_ids_from_webid(inputdir, outputdir, drf, url='https://full-spectrum.sandia.gov/', bkg_file=None, synthesize_bkg=False):
@@ -79,6 +79,9 @@ RESULTS_TBL_COLS_DEFAULT = []
 BASE_SPECTRUM_CREATION_CONFIG_KEY = 'Base Spectrum Creation Configuration File'
 BASE_SPECTRUM_CREATION_CONFIG_DEFAULT = os.path.join(APPLICATION_PATH, 'base_spectra_config.yaml')
 
+SAMPLE_GENERATION_WORKERS_KEY = 'Sample Generation Worker Processes'
+SAMPLE_GENERATION_WORKERS_DEFAULT = 1
+
 WEBID_DRFS_KEY = 'WebID DRFs'
 WEBID_DRFS_DEFAULT = []
 # WEBID_DRFS_DEFAULT = ['1x1/BGO Side', '1x1/CsI Side', '1x1/LaCl3', '1x1/NaI Front', '1x1/NaI Side', '3x3/NaI AboveSource', '3x3/NaI InCorner', '3x3/NaI LowScat', '3x3/NaI MidScat', '3x3/NaI OnGround', 'ASP-Thermo', 'Apollo/Bottom', 'Apollo/Front', 'Atomex-AT6102', 'D3S', 'Detective', 'Detective-EX', 'Detective-EX100', 'Detective-EX200', 'Detective-Micro', 'Detective-Micro/Variant-LowEfficiency', 'Detective-X', 'Falcon 5000', 'FieldSpec', 'GR130', 'GR135', 'GR135Plus', 'IdentiFINDER-LaBr3', 'IdentiFINDER-N', 'IdentiFINDER-NG', 'IdentiFINDER-NGH', 'IdentiFINDER-R300', 'IdentiFINDER-R500-NaI', 'InSpector 1000 LaBr3', 'InSpector 1000 NaI', 'Interceptor', 'LaBr3Marlow', 'LaBr3PNNL', 'MKC-A03', 'Mirion PDS-100', 'Polimaster PM1704-GN', 'RIIDEyeX-GN1', 'RadEagle', 'RadEye', 'RadPack', 'RadSeeker-NaI', 'Radseeker-LaBr3', 'Raider', 'Ranger', 'SAM-935', 'SAM-945', 'SAM-950GN-N30', 'SAM-Eagle-LaBr3', 'SAM-Eagle-NaI-3x3', 'SpiR-ID/LaBr3', 'SpiR-ID/NaI', 'Thermo ARIS Portal', 'Transpec', 'Verifinder']
@@ -129,6 +132,9 @@ class RaseSettings:
         if not self.settings.value(WEBID_DRFS_KEY):
             self.settings.setValue(WEBID_DRFS_KEY, WEBID_DRFS_DEFAULT)
 
+        if not self.settings.value(SAMPLE_GENERATION_WORKERS_KEY):
+            self.settings.setValue(SAMPLE_GENERATION_WORKERS_KEY, SAMPLE_GENERATION_WORKERS_DEFAULT)
+
         # this is qt internal settings store
         self.qtsettings = QtCore.QSettings(QtCore.QSettings.UserScope, "qtproject")
 
@@ -322,3 +328,15 @@ class RaseSettings:
         Sets List of DRFs in WebID
         """
         self.settings.setValue(WEBID_DRFS_KEY, drf_list)
+
+    def getSampleGenerationWorkers(self):
+        """
+        Returns number of worker processes used to generate sample spectra
+        """
+        return int(self.settings.value(SAMPLE_GENERATION_WORKERS_KEY))
+
+    def setSampleGenerationWorkers(self, workers):
+        """
+        Sets number of worker processes used to generate sample spectra
+        """
+        self.settings.setValue(SAMPLE_GENERATION_WORKERS_KEY, workers)
@@ -0,0 +1,260 @@
+###############################################################################
+# Copyright (c) 2018-2023 Lawrence Livermore National Security, LLC.
+# Produced at the Lawrence Livermore National Laboratory
+#
+# Written by J. Brodsky, J. Chavez, S. Czyz, G. Kosinovsky, V. Mozin,
+#            S. Sangiorgio.
+#
+# RASE-support@llnl.gov.
+#
+# LLNL-CODE-858590, LLNL-CODE-829509
+#
+# All rights reserved.
+#
+# This file is part of RASE.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED,INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""
+This module generates the sample spectra of detector/scenario pairs, either serially or with a pool of processes.
+It does not depend on Qt so that it can be run in worker processes.
+"""
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import product
+import multiprocessing
+from queue import Empty
+
+import numpy as np
+from src.rase_functions import initializeDatabase, N42Writer, N42TemplateRenderer, get_n42_template, \
+    get_sample_dir, get_replay_input_dir, get_sample_spectra_filename, secondary_type, _getCountsDoseAndSensitivity
+from src.sampling_algos import sample_counts_batch, sample_seed_sequence, replication_rng, SECONDARY_STREAM, \
+    SMEARING_STREAM
+from src.table_def import Session, Detector, Scenario, BackgroundSpectrum, DetectorInfluence, ReplayTypes
+
+# maximum number of channel values sampled at once when replications are generated in batches
+BATCH_MAX_VALUES = 2 ** 23
+
+
+def generate_sample_spectra(det_name, scen_id, sample_root, sampling_algo, seed, test=False, step=None):
+    """
+    Generates and writes out all replications of the sample spectra of one detector/scenario pair.
+    Results only depend on the seed, so they are identical whichever process generates them.
+
+    :param det_name: detector name
+    :param scen_id: scenario id
+    :param sample_root: directory where the sample spectra folders are created
+    :param sampling_algo: one of the sampling_algos.generate_sample_counts_* functions
+    :param seed: seed stored in the SampleSpectraSeed table for this pair
+    :param test: if True, only one replication is generated
+    :param step: optional function called after each replication; returning True aborts the generation
+    :return: True if all replications were generated, False if aborted
+    """
+    session = Session()
+    detector = session.query(Detector).filter_by(name=det_name).first()
+    scenario = session.query(Scenario).filter_by(id=scen_id).first()
+    sample_dir = get_sample_dir(sample_root, detector, scen_id)
+    replay_input_dir = get_replay_input_dir(sample_root, detector, scen_id)
+
+    os.makedirs(sample_dir, exist_ok=True)
+    os.makedirs(replay_input_dir, exist_ok=True)
+
+    # each replication draws from its own streams, so that it can be regenerated independently
+    seed_sequence = sample_seed_sequence(seed, detector.name, scenario.id)
+
+    countsDoseAndSensitivity = _getCountsDoseAndSensitivity(
+        scenario, detector, rng=replication_rng(seed_sequence, 0, SMEARING_STREAM))
+
+    secondary_spectrum = _get_secondary_spectrum(session, detector, scenario)
+    if secondary_spectrum and detector.bckg_spectra_resample:
+        original_secondary_spe_counts = secondary_spectrum.counts
+
+    # the parts of the RASE n42 files common to all replications are only rendered once
+    n42_writer = N42Writer(scenario, detector, secondary_spectrum)
+
+    # the template is compiled once, and only the variables it uses are computed for each replication
+    n42_renderer = None
+    if detector.replay and detector.replay.type == ReplayTypes.standalone and detector.replay.n42_template_path:
+        n42_renderer = N42TemplateRenderer(get_n42_template(detector.replay.n42_template_path), scenario,
+                                           detector, secondary_spectrum)
+
+    # degradation of each influence per replication
+    degradation_steps = []
+    for influence in scenario.influences:
+        influences = session.query(DetectorInfluence).filter_by(influence_name=influence.name).first()
+        degradation_steps.append([influences.degrade_infl0, influences.degrade_infl1, influences.degrade_infl2,
+                                  influences.degrade_f_smear, influences.degrade_l_smear])
+    is_degraded = not all(v == 0 for deg in degradation_steps for v in deg)
+
+    # without degradations all replications share the same base spectra and are sampled in batches
+    batch_size = max(1, BATCH_MAX_VALUES // detector.chan_count)
+
+    # create 'replication' number of files
+    reps = 1 if test else scenario.replication
+    for filenum in range(reps):
+        # This is where the downsampling happens
+        secondary_counts = None
+        if secondary_spectrum and detector.bckg_spectra_resample:
+            secondary_counts = replication_rng(seed_sequence, filenum, SECONDARY_STREAM).poisson(
+                original_secondary_spe_counts)
+
+        if is_degraded:
+            # If there is some degradation, we pass them in to apply degradations without doing it exponentially
+            degradations = [[a * filenum for a in deg] for deg in degradation_steps]
+            if filenum > 0:
+                countsDoseAndSensitivity = _getCountsDoseAndSensitivity(
+                    scenario, detector, degradations, replication_rng(seed_sequence, filenum, SMEARING_STREAM))
+            sampleCounts = sampling_algo(scenario, detector, countsDoseAndSensitivity,
+                                         replication_rng(seed_sequence, filenum))
+        else:
+            if filenum % batch_size == 0:
+                batch_counts = sample_counts_batch(sampling_algo, scenario, detector,
+                                                   countsDoseAndSensitivity, seed_sequence,
+                                                   min(batch_size, reps - filenum), first=filenum)
+            sampleCounts = batch_counts[filenum % batch_size]
+
+        # write out to RASE n42 file
+        fname = os.path.join(sample_dir, get_sample_spectra_filename(detector.id, scenario.id, filenum, ".n42"))
+        n42_writer.write(fname, sampleCounts, secondary_counts)
+
+        # write out to translated file format
+        if n42_renderer:
+            fname = os.path.join(replay_input_dir,
+                                 get_sample_spectra_filename(detector.id, scenario.id, filenum,
+                                                             detector.replay.input_filename_suffix))
+            n42_renderer.write(fname, sampleCounts, secondary_counts)
+
+        if step is not None and step():
+            # delete current folders since generation was incomplete
+            if os.path.exists(sample_dir):
+                shutil.rmtree(sample_dir)
+            if os.path.exists(replay_input_dir):
+                shutil.rmtree(replay_input_dir)
+            return False
+
+    return True
+
+
+def _get_secondary_spectrum(session, detector, scenario):
+    """
+    Returns the secondary spectrum to be included in the sample spectra of the detector, if any
+    """
+    # ???: if present, should distorsions be applied to the secondary background? <SS>
+    secondary_spectrum = None
+    secondary_is_float = False
+    if detector.includeSecondarySpectrum:
+        secondary_spectrum = (session.query(BackgroundSpectrum).filter_by(detector_name=detector.name)).first()
+
+        if detector.secondary_type == secondary_type['scenario']:  # utilize background defined in the scenario for secondary background
+            secondary_spectrum = BackgroundSpectrum()
+            spec_info = []
+            for background, spectrum in product(scenario.scen_bckg_materials, detector.base_spectra):
+                if background.material_name == spectrum.material_name:
+                    cnts = spectrum.get_counts_as_np()
+                    secondary_is_float = secondary_is_float or not all([float(k) == int(k) for k in cnts])
+                    sens = spectrum.rase_sensitivity if background.fd_mode == 'DOSE' else spectrum.flux_sensitivity
+                    spec_info.append({'counts': cnts, 'livetime': spectrum.livetime, 'realtime': spectrum.realtime,
+                                      'sens': sens, 'bkg_dose': background.dose})
+
+            secondary_spectrum.livetime = spec_info[0]['livetime']
+            secondary_spectrum.realtime = spec_info[0]['realtime']
+            for s in spec_info:
+                if s['livetime'] > secondary_spectrum.livetime:
+                    secondary_spectrum.livetime = s['livetime']
+                    secondary_spectrum.realtime = s['realtime']
+            # use maximum livetime of scenario bgnd specs unless bckg_spectra_dwell is specified
+            if detector.bckg_spectra_dwell != 0:
+                secondary_spectrum.realtime = detector.bckg_spectra_dwell * (secondary_spectrum.realtime /
+                                                                             secondary_spectrum.livetime)
+                secondary_spectrum.livetime = detector.bckg_spectra_dwell
+            secondary_spectrum.counts = np.zeros(len(spec_info[0]['counts']))
+            for s in spec_info:
+                secondary_spectrum.counts += secondary_spectrum.livetime * s['sens'] * s['bkg_dose'] * \
+                                             (s['counts'] / np.sum(s['counts']))
+        else:
+            secondary_is_float = not all([float(k) == int(k) for k in secondary_spectrum.counts])
+            if detector.bckg_spectra_dwell != 0:
+                secondary_spectrum.counts *= detector.bckg_spectra_dwell / secondary_spectrum.livetime
+                secondary_spectrum.realtime = detector.bckg_spectra_dwell * (secondary_spectrum.realtime /
+                                                                             secondary_spectrum.livetime)
+                secondary_spectrum.livetime = detector.bckg_spectra_dwell
+        if not secondary_is_float:
+            secondary_spectrum.counts = secondary_spectrum.counts.astype(int)
+    return secondary_spectrum
+
+
+def generate_sample_spectra_parallel(work_units, sample_root, sampling_algo, workers, test=False,
+                                     step=None, poll_interval=0.1):
+    """
+    Generates the sample spectra of several detector/scenario pairs with a pool of worker processes.
+    Each worker binds its own database session to the current database file.
+
+    :param work_units: list of (detector name, scenario id, seed) tuples
+    :param sample_root: directory where the sample spectra folders are created
+    :param sampling_algo: one of the sampling_algos.generate_sample_counts_* functions
+    :param workers: number of worker processes
+    :param test: if True, only one replication per pair is generated
+    :param step: optional function called with the number of replications completed since its last call,
+                 at least every poll_interval seconds; returning True aborts the generation
+    :param poll_interval: seconds between progress updates
+    :return: True if all pairs were generated, False if aborted
+    """
+    db_path = Session().get_bind().url.database
+    # worker processes are spawned rather than forked from the (multi-threaded) GUI process
+    mp_context = multiprocessing.get_context('spawn')
+    aborted = False
+    with mp_context.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=initializeDatabase,
+                                initargs=(db_path,)) as pool:
+        progress = manager.Queue()
+        abort_event = manager.Event()
+        pending = {pool.submit(_generate_in_worker, det_name, scen_id, sample_root, sampling_algo, seed, test,
+                               progress, abort_event) for det_name, scen_id, seed in work_units}
+        while pending:
+            done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                if not future.cancelled():
+                    future.result()  # propagate exceptions raised in the workers
+            completed = 0
+            try:
+                while True:
+                    completed += progress.get_nowait()
+            except Empty:
+                pass
+            if step is not None and step(completed) and not aborted:
+                aborted = True
+                abort_event.set()
+                for future in pending:
+                    future.cancel()
+    return not aborted
+
+
+def _generate_in_worker(det_name, scen_id, sample_root, sampling_algo, seed, test, progress, abort_event):
+    """
+    Runs generate_sample_spectra() in a worker process, reporting progress through a shared queue
+    """
+    def step():
+        progress.put(1)
+        return abort_event.is_set()
+
+    try:
+        return generate_sample_spectra(det_name, scen_id, sample_root, sampling_algo, seed, test, step)
+    finally:
+        Session.remove()
@@ -36,53 +36,31 @@ This module implements available sampling algorithms
 
 # Note: The first line in the docstring is used as the readable name for the downsampling method
 
+import hashlib
+
 import numpy as np
 
+# independent random streams used within each replication
+SAMPLING_STREAM, SECONDARY_STREAM, SMEARING_STREAM = range(3)
+
 
 def generate_sample_counts_rejection(scenario, detector, countsDoseAndSensitivity, seed):
     """ Rejection Sampling
     This is a modified version of the rejection algorithm employed by the IAEA in the original
     iteration of RASE (10.1109/NSSMIC.2009.5402448)
 
-    :param seed:
+    Candidate channels are drawn uniformly and accepted with probability pdf[x] / max(pdf) in whole blocks;
+    the first 'integral' accepted candidates are histogrammed with np.bincount.
+
+    :param seed: seed or np.random.Generator
     :param scenario:
     :param detector:
     :param countsDoseAndSensitivity:
     :return:
     """
+    rng = np.random.default_rng(seed)
 
-    np.random.seed(seed)
-
-    sampleCounts = np.zeros(detector.chan_count, dtype=int)
-
-    for counts, dose, sensitivity in countsDoseAndSensitivity:
-        counts[counts < 0] = 0
-
-        pdf = np.array(counts) / sum(counts.astype(float))
-        integral = np.random.poisson(scenario.acq_time * dose * sensitivity)
-
-        i = 0
-        counts_len = len(counts)
-
-        while integral > 0:
-            # there might be an optimization possible between the size of the array of random numbers
-            # and the looping through each array
-            xx = np.random.randint(0, counts_len, size=integral * 10)
-            yy = np.random.random_sample(integral * 10)
-
-            for x in xx[np.where(yy <= pdf[xx])]:
-                if i < integral:
-                    sampleCounts[x] += 1
-                    i += 1
-                else:
-                    break
-            # this else is executed only if no 'break' statement was encountered in the for loop
-            else:
-                continue
-
-            break
-
-    return sampleCounts
+    return _draw_rejection(rng, _pdfs_and_intensities(scenario, countsDoseAndSensitivity), detector.chan_count)
 
 
 def generate_sample_counts_poisson(scenario, detector, countsDoseAndSensitivity, seed):
@@ -92,46 +70,182 @@ def generate_sample_counts_poisson(scenario, detector, countsDoseAndSensitivity,
     :param scenario:
     :param detector:
     :param countsDoseAndSensitivity:
-    :param seed:
+    :param seed: seed or np.random.Generator
     :return:
     """
-    sampleCounts = [0] * detector.chan_count
+    rng = np.random.default_rng(seed)
 
-    np.random.seed(seed)
-
-    # sum up
-    for counts, dose, sensitivity in countsDoseAndSensitivity:
-        counts[counts < 0] = 0
-        counts = counts.astype(float) * (scenario.acq_time * dose * sensitivity) / sum(counts.astype(float))
-        counts = np.random.poisson(counts)  # Poisson noise
-        sampleCounts += counts
-    return sampleCounts.astype(int)
+    return _draw_poisson(rng, _expected_counts(scenario, countsDoseAndSensitivity), detector.chan_count)
 
 
 def generate_sample_counts_inversion(scenario, detector, countsDoseAndSensitivity, seed):
     """Inverse Transform Sampling
-    This uses np.random.choice() which is rather fast and employs the inverse transform sampling method
+    This uses Generator.choice() which is rather fast and employs the inverse transform sampling method
     which generates random numbers from a probability distribution given its cumulative distribution function.
 
     :param scenario:
     :param detector:
     :param countsDoseAndSensitivity:
-    :param seed:
+    :param seed: seed or np.random.Generator
     :return:
     """
-    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+
+    return _draw_inversion(rng, _pdfs_and_intensities(scenario, countsDoseAndSensitivity), detector.chan_count)
+
+
+def sample_counts_batch(sampling_algo, scenario, detector, countsDoseAndSensitivity, seed_sequence, replications,
+                        first=0):
+    """
+    Generates several replications at once with the given sampling algorithm.
+    The base spectra are normalized only once, and row i of the output is identical to
+    sampling_algo(scenario, detector, countsDoseAndSensitivity, replication_rng(seed_sequence, first + i))
+
+    :param sampling_algo: one of the generate_sample_counts_* functions
+    :param scenario:
+    :param detector:
+    :param countsDoseAndSensitivity:
+    :param seed_sequence: np.random.SeedSequence of the detector/scenario pair, see sample_seed_sequence()
+    :param replications: number of replications to generate
+    :param first: index of the first replication
+    :return: integer array of shape (replications, detector.chan_count)
+    """
+    sampleCounts = np.zeros((replications, detector.chan_count), dtype=int)
+
+    if sampling_algo not in _batch_algos:
+        # unknown algorithm: fall back to one call per replication
+        for i in range(replications):
+            cds = [(np.array(counts), dose, sensitivity) for counts, dose, sensitivity in countsDoseAndSensitivity]
+            sampleCounts[i] = sampling_algo(scenario, detector, cds, replication_rng(seed_sequence, first + i))
+        return sampleCounts
+
+    prepare, draw = _batch_algos[sampling_algo]
+    prepared = prepare(scenario, countsDoseAndSensitivity)
+    for i in range(replications):
+        sampleCounts[i] = draw(replication_rng(seed_sequence, first + i), prepared, detector.chan_count)
+    return sampleCounts
+
+
+def sample_seed_sequence(seed, detector_name, scenario_id):
+    """
+    Root of the random streams of a detector/scenario pair, derived from its SampleSpectraSeed row.
+    Different pairs get independent streams even when they share the same (fixed) seed.
+
+    :param seed: SampleSpectraSeed.seed
+    :param detector_name: SampleSpectraSeed.det_name
+    :param scenario_id: SampleSpectraSeed.scen_id
+    :return: np.random.SeedSequence
+    """
+    return np.random.SeedSequence([int(seed), _stable_hash(detector_name), _stable_hash(scenario_id)])
+
+
+def replication_rng(seed_sequence, filenum, stream=SAMPLING_STREAM):
+    """
+    Random generator of one stream of one replication.
+    Depends only on the seed sequence, the replication number and the stream, so that any replication
+    can be regenerated on its own, in any process, independently of the order of generation.
+
+    :param seed_sequence: np.random.SeedSequence from sample_seed_sequence()
+    :param filenum: replication number
+    :param stream: one of SAMPLING_STREAM, SECONDARY_STREAM, SMEARING_STREAM
+    :return: np.random.Generator
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed_sequence.entropy,
+                                                        spawn_key=seed_sequence.spawn_key + (filenum, stream)))
+
 
-    sampleCounts = np.zeros(detector.chan_count, dtype=int)
+def _stable_hash(text):
+    """32-bit integer hash of a string that does not change between python sessions"""
+    return int(hashlib.md5(str(text).encode('utf-8')).hexdigest()[:8], 16)
 
+
+# Each sampling algorithm is split into a preparation step, which only depends on the base spectra and
+# can be shared by all replications, and a draw step using the np.random.Generator 'rng'.
+
+def _expected_counts(scenario, countsDoseAndSensitivity):
+    """
+    Base spectra scaled to the expected number of counts for the scenario
+    :return: array of shape (number of materials, channels)
+    """
+    expected = []
     for counts, dose, sensitivity in countsDoseAndSensitivity:
         counts[counts < 0] = 0
+        expected.append(counts.astype(float) * (scenario.acq_time * dose * sensitivity) / sum(counts.astype(float)))
+    return np.array(expected)
 
-        pdf = np.array(counts) / sum(counts.astype(float))
-        integral = np.random.poisson(scenario.acq_time * dose * sensitivity)
 
-        x = np.random.choice(len(pdf), size=integral, p=pdf)
-        for k in x:
-            sampleCounts[k] += 1
+def _draw_poisson(rng, expected, chan_count):
+    sampleCounts = np.zeros(chan_count, dtype=int)
+    if len(expected):
+        sampleCounts += rng.poisson(expected).sum(axis=0)  # Poisson noise
+    return sampleCounts
+
 
+def _pdfs_and_intensities(scenario, countsDoseAndSensitivity):
+    """
+    Probability distribution and expected total counts of each base spectrum
+    :return: list of (pdf, expected counts) tuples
+    """
+    pdfs = []
+    for counts, dose, sensitivity in countsDoseAndSensitivity:
+        counts[counts < 0] = 0
+        pdfs.append((np.array(counts) / sum(counts.astype(float)), scenario.acq_time * dose * sensitivity))
+    return pdfs
+
+
+def _draw_inversion(rng, pdfs, chan_count):
+    sampleCounts = np.zeros(chan_count, dtype=int)
+    for pdf, intensity in pdfs:
+        integral = rng.poisson(intensity)
+        x = rng.choice(len(pdf), size=integral, p=pdf)
+        sampleCounts += np.bincount(x, minlength=chan_count)[:chan_count]
+    return sampleCounts
+
+
+def _draw_rejection(rng, pdfs, chan_count):
+    sampleCounts = np.zeros(chan_count, dtype=int)
+    for pdf, intensity in pdfs:
+        integral = rng.poisson(intensity)
+        if integral > 0:
+            accepted = _rejection_sample_channels(rng, pdf, integral)
+            sampleCounts += np.bincount(accepted, minlength=chan_count)[:chan_count]
     return sampleCounts
 
+
+# upper bound on the number of candidates drawn at once by the rejection sampler, to limit memory usage
+REJECTION_MAX_BLOCK_SIZE = 2 ** 22
+
+
+def _rejection_sample_channels(rng, pdf, integral):
+    """
+    Draws 'integral' channel indices distributed according to 'pdf' by accepting or rejecting
+    blocks of uniformly distributed candidates
+
+    :param rng: np.random.Generator
+    :param pdf: normalized probability of each channel
+    :param integral: number of channel indices to draw
+    :return: array of accepted channel indices, in the order they were drawn
+    """
+    pdf_max = pdf.max()
+    # expected fraction of accepted candidates when using max(pdf) as the envelope
+    acceptance = 1 / (len(pdf) * pdf_max)
+
+    accepted = []
+    n_accepted = 0
+    while n_accepted < integral:
+        remaining = integral - n_accepted
+        block_size = min(int(remaining / acceptance * 1.1) + 64, REJECTION_MAX_BLOCK_SIZE)
+        xx = rng.integers(0, len(pdf), size=block_size)
+        yy = rng.random(block_size) * pdf_max
+        block = xx[yy < pdf[xx]][:remaining]
+        accepted.append(block)
+        n_accepted += len(block)
+
+    return np.concatenate(accepted)
+
+
+_batch_algos = {
+    generate_sample_counts_poisson: (_expected_counts, _draw_poisson),
+    generate_sample_counts_inversion: (_pdfs_and_intensities, _draw_inversion),
+    generate_sample_counts_rejection: (_pdfs_and_intensities, _draw_rejection),
+}
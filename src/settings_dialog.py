@@ -59,6 +59,9 @@ class SettingsDialog(ui_prefs_dialog.Ui_Dialog, QDialog):
         algoCount = 0
 
         for name, data in inspect.getmembers(sampling_algos, predicate=inspect.isfunction):
+            # only the sampling algorithms themselves are listed, not their helper functions
+            if not name.startswith('generate_sample_counts_'):
+                continue
             try:
                 readable_name = data.__doc__.splitlines()[0].strip()
                 if readable_name == '':
@@ -72,6 +75,7 @@ class SettingsDialog(ui_prefs_dialog.Ui_Dialog, QDialog):
             algoCount += 1
         self.algorithmSelected = False
         self.downSapmplingAlgoComboBox.currentIndexChanged.connect(self.chooseSamplingAlgo)
+        self.spinGenerationWorkers.setValue(self.settings.getSampleGenerationWorkers())
 
     @Slot(bool)
     def on_btnBrowseDataDir_clicked(self, checked):
@@ -100,6 +104,7 @@ class SettingsDialog(ui_prefs_dialog.Ui_Dialog, QDialog):
         idx = self.downSapmplingAlgoComboBox.currentIndex()
         if self. algorithmSelected:
             self.settings.setSamplingAlgo(self.algoDictionary[idx])
+        self.settings.setSampleGenerationWorkers(self.spinGenerationWorkers.value())
         # if current state is different from initial state (somehow record the initial state so if the user toggles
         # but then toggles back the user is not prompted to reset RASE)
 
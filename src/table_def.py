@@ -37,7 +37,7 @@ import enum
 import random
 import string
 
-from sqlalchemy import ForeignKey, Column, Integer, String, Float, Boolean, Enum, JSON, UniqueConstraint
+from sqlalchemy import ForeignKey, Column, Integer, String, Float, Boolean, Enum, JSON, UniqueConstraint, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm             import relationship, sessionmaker, scoped_session, backref, Mapped
@@ -47,7 +47,7 @@ import numpy as np
 import hashlib
 from typing import Set, Sequence, MutableSequence
 import json
-from src.utils import compress_counts
+from src.utils import compress_counts, counts_to_bytes, counts_from_bytes, COUNTS_HEADER
 
 DB_VERSION_NAME = 'rase_db_v1_8'
 
@@ -346,7 +346,7 @@ class Spectrum(Base):
     __tablename__ = 'spectra'
     id            = Column(Integer, primary_key=True)
     filename      = Column(String)
-    baseCounts    = Column(String)
+    counts_blob   = Column(LargeBinary)  # see utils.counts_to_bytes()
     realtime      = Column(Float)
     livetime      = Column(Float)
     ecal0         = Column(Float)
@@ -369,11 +369,8 @@ class Spectrum(Base):
 
     def is_spectrum_float(self):
         """Checks if spectrum has floats in it or not"""
-        for binval in self.baseCounts.split(','):
-            c = float(binval)
-            if c and (c < 1 or int(c) % c):
-                return True
-        return False
+        c = self.counts_view
+        return bool(np.any((c != 0) & ((c < 1) | (c % 1 != 0))))
 
 
     @declared_attr
@@ -384,16 +381,40 @@ class Spectrum(Base):
                             "livetime": self.livetime,
                             "realtime": self.realtime,
                             "xeqn": list(self.ecal),
-                            "y": [float(c) for c in self.baseCounts.split(',')],
+                            "y": self.counts_view.tolist(),
                             "yScaleFactor": 1,
                             }])
 
+    @property
+    def counts_view(self):
+        """Read-only array of the counts, decoded once per stored value"""
+        blob = self.counts_blob
+        if blob is None:
+            return None
+        cached = self.__dict__.get('_counts_cache')
+        if cached is None or cached[0] is not blob:
+            cached = self._counts_cache = (blob, counts_from_bytes(blob))
+        return cached[1]
+
     @property
     def counts(self):
-        return np.array([float(c) for c in self.baseCounts.split(",")])
+        return np.array(self.counts_view)
     @counts.setter
     def counts(self, value):
-        self.baseCounts = ','.join([str(c) for c in value])
+        self.counts_blob = counts_to_bytes(value)
+
+    @property
+    def baseCounts(self):
+        """Counts as a comma-separated string, as they were stored in earlier database versions"""
+        if self.counts_blob is None:
+            return None
+        counts = self.counts_view
+        if COUNTS_HEADER.unpack_from(self.counts_blob)[0].startswith(b'<u'):
+            counts = counts.astype(np.int64)
+        return ','.join(map(str, counts.tolist()))
+    @baseCounts.setter
+    def baseCounts(self, value):
+        self.counts_blob = None if value is None else counts_to_bytes(np.array(value.split(','), dtype=float))
 
     @property
     def ecal(self):
@@ -406,23 +427,21 @@ class Spectrum(Base):
 
     #legacy
     def get_counts_as_np(self)->Sequence[float]:
-        return np.array([float(c) for c in self.baseCounts.split(",")])
+        return self.counts
 
     #legacy
     def get_counts_as_str(self):
         if self.is_spectrum_float():
-            return ' '.join([str(float(c)) for c in self.baseCounts.split(",")])
+            return ' '.join(map(str, self.counts_view.tolist()))
         else:
-            return ' '.join([str(int(float(c))) for c in self.baseCounts.split(",")])
+            return ' '.join(map(str, self.counts_view.astype(np.int64).tolist()))
 
 
     def get_compressed_counts_as_str(self):
         if self.is_spectrum_float():
-            return ' '.join('{:f}'.format(x) for x in
-                            compress_counts(np.array([float(c) for c in self.baseCounts.split(",")])))
+            return ' '.join('{:f}'.format(x) for x in compress_counts(self.counts_view))
         else:
-            return ' '.join('{:d}'.format(x) for x in
-                            compress_counts(np.array([int(float(c)) for c in self.baseCounts.split(",")])))
+            return ' '.join(map(str, compress_counts(self.counts_view.astype(np.int64)).tolist()))
 
 class BaseSpectrum(Spectrum):
     __tablename__ = 'base_spectra'
@@ -438,9 +457,9 @@ class BaseSpectrum(Spectrum):
         intensity_dose = None
         intensity_flux = None
         if self.rase_sensitivity:
-            intensity_dose = float(f'{(sum(self.counts) / self.livetime / self.rase_sensitivity):.3g}')
+            intensity_dose = float(f'{(self.counts_view.sum() / self.livetime / self.rase_sensitivity):.3g}')
         if self.flux_sensitivity:
-            intensity_flux = float(f'{(sum(self.counts) / self.livetime / self.flux_sensitivity):.3g}')
+            intensity_flux = float(f'{(self.counts_view.sum() / self.livetime / self.flux_sensitivity):.3g}')
         return intensity_dose, intensity_flux
 
 class BaseSpectrumXYZ(Spectrum):
@@ -518,8 +537,9 @@ class BaseSpectrumSchema(SQLAlchemyAutoSchema):
         model=BaseSpectrum
         load_instance=True
         include_relationships = True
-        exclude = ("id","spectrum_type")
+        exclude = ("id","spectrum_type","counts_blob")
 
+    baseCounts = mfields.String()
     material = fields.Nested(MaterialSchema)
 
 class SecondarySpectrumSchema(SQLAlchemyAutoSchema):
@@ -527,7 +547,8 @@ class SecondarySpectrumSchema(SQLAlchemyAutoSchema):
         model=SecondarySpectrum
         load_instance=True
         include_relationships = True
-        exclude = ("id","spectrum_type","material","filename")
+        exclude = ("id","spectrum_type","material","filename","counts_blob")
+    baseCounts = mfields.String()
 
 
 class BackgroundSpectrumSchema(SQLAlchemyAutoSchema):
@@ -535,7 +556,8 @@ class BackgroundSpectrumSchema(SQLAlchemyAutoSchema):
         model=BackgroundSpectrum
         load_instance=True
         include_relationships = True
-        exclude = ("id","spectrum_type")
+        exclude = ("id","spectrum_type","counts_blob")
+    baseCounts = mfields.String()
     material = fields.Nested(MaterialSchema)
 
 class ReplaySchema(SQLAlchemyAutoSchema):
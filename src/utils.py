@@ -31,12 +31,15 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 ###############################################################################
 """
-This module defines profileit(), compress_counts(), and other utility functions
+This module defines profileit(), compress_counts(), counts_to_bytes(), and other utility functions
 """
 import os
 import re
+import struct
 import sys
 
+import numpy as np
+
 PROFILE = False
 
 
@@ -65,26 +68,59 @@ def profileit(func):
 
 def compress_counts(counts):
     """
+    Compresses counts with the N42 "CountedZeroes" scheme: each run of zeros is replaced by a zero
+    followed by the length of the run
 
-    :param counts:
-    :return:
+    :param counts: array of counts
+    :return: array of compressed counts
     """
-    compressedCounts = []
+    counts = np.asarray(counts)
+    zero = counts == 0
+    run_starts = np.flatnonzero(zero & ~np.concatenate(([False], zero[:-1])))
+    run_ends = np.flatnonzero(zero & ~np.concatenate((zero[1:], [False]))) + 1
+    non_zero = np.flatnonzero(~zero)
 
-    zeroTimes = 0
-    for count in counts:
-        if count == 0:
-            zeroTimes += 1
-        else:
-            if zeroTimes != 0:
-                compressedCounts.append(0)
-                compressedCounts.append(zeroTimes)
-                zeroTimes = 0
-            compressedCounts.append(count)
-    if counts[-1] == 0:
-        compressedCounts.append(0)
-        compressedCounts.append(zeroTimes)
-    return compressedCounts
+    # interleave non-zero counts with (0, run length) pairs at the position of each run
+    positions = np.concatenate((2 * non_zero, 2 * run_starts, 2 * run_starts + 1))
+    values = np.concatenate((counts[non_zero], np.zeros(len(run_starts), dtype=counts.dtype), run_ends - run_starts))
+    return values[np.argsort(positions, kind='stable')]
+
+
+# header of the binary counts buffers: numpy dtype string and number of channels
+COUNTS_HEADER = struct.Struct('<4sI')
+
+
+def counts_to_bytes(counts):
+    """
+    Encodes counts as a typed binary buffer, as stored in the database.
+    Non-negative integer counts are stored with the smallest sufficient unsigned type, other counts as doubles.
+
+    :param counts: array of counts
+    :return: bytes with a header giving the dtype and length of the counts, followed by the counts
+    """
+    counts = np.asarray(counts, dtype=np.float64).ravel()
+    dtype = np.dtype('<f8')
+    if len(counts) and np.all(np.isfinite(counts)) and counts.min() >= 0 and np.all(counts % 1 == 0):
+        if counts.max() < 2 ** 16:
+            dtype = np.dtype('<u2')
+        elif counts.max() < 2 ** 32:
+            dtype = np.dtype('<u4')
+    return COUNTS_HEADER.pack(dtype.str.encode(), len(counts)) + counts.astype(dtype).tobytes()
+
+
+def counts_from_bytes(buffer):
+    """
+    Decodes a binary buffer created by counts_to_bytes()
+
+    :param buffer: bytes with the encoded counts
+    :return: read-only float array of the counts
+    """
+    dtype, length = COUNTS_HEADER.unpack_from(buffer)
+    counts = np.frombuffer(buffer, dtype=dtype.decode().strip(), count=length, offset=COUNTS_HEADER.size)
+    if counts.dtype != np.float64:
+        counts = counts.astype(np.float64)
+        counts.setflags(write=False)
+    return counts
 
 
 def atoi(text):
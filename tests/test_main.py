@@ -624,6 +624,54 @@ class Test_Workflow:
         spec_status = w.genSpectra(scen_ids, det_names, dispProg=False)
         assert spec_status
 
+    def test_spec_gen_parallel(self, tmp_path):
+        """Verifies worker processes generate the same spectra as serial generation for the same seeds"""
+        from src.sample_generation import generate_sample_spectra, generate_sample_spectra_parallel
+        from src.sampling_algos import generate_sample_counts_poisson
+
+        hoc = HelpObjectCreation()
+        det_names, scen_ids = hoc.get_default_workflow()
+        work_units = [(det_names[0], scen_id, 100 + i) for i, scen_id in enumerate(scen_ids)]
+
+        for det_name, scen_id, seed in work_units:
+            assert generate_sample_spectra(det_name, scen_id, str(tmp_path / 'serial'),
+                                           generate_sample_counts_poisson, seed)
+        assert generate_sample_spectra_parallel(work_units, str(tmp_path / 'parallel'),
+                                                generate_sample_counts_poisson, 2)
+
+        serial_files = sorted(p.relative_to(tmp_path / 'serial') for p in (tmp_path / 'serial').rglob('*.n42'))
+        assert serial_files
+        assert serial_files == sorted(p.relative_to(tmp_path / 'parallel')
+                                      for p in (tmp_path / 'parallel').rglob('*.n42'))
+        for f in serial_files:
+            assert (tmp_path / 'serial' / f).read_text() == (tmp_path / 'parallel' / f).read_text()
+
+    def test_base_counts_cache(self):
+        """Verifies the cached base spectra are reused, and refreshed when a base spectrum is edited"""
+        from src.rase_functions import _getCountsDoseAndSensitivity, _get_base_counts
+
+        hoc = HelpObjectCreation()
+        det_names, scen_ids = hoc.get_default_workflow()
+        session = Session()
+        detector = session.query(Detector).filter_by(name=det_names[0]).first()
+        scenario = session.query(Scenario).filter_by(id=scen_ids[0]).first()
+
+        _get_base_counts.cache_clear()
+        c_d_s = _getCountsDoseAndSensitivity(scenario, detector)
+        assert np.array_equal(c_d_s[0][0], _getCountsDoseAndSensitivity(scenario, detector)[0][0])
+        assert _get_base_counts.cache_info().hits == len(c_d_s)
+
+        base_spectrum = session.query(BaseSpectrum).filter_by(
+            detector_name=detector.name, material_name=scenario.scen_materials[0].material_name).first()
+        original_counts = base_spectrum.baseCounts
+        base_spectrum.counts = base_spectrum.counts * 2
+        session.commit()
+        assert _get_base_counts.cache_info().currsize == 0
+        assert np.allclose(_getCountsDoseAndSensitivity(scenario, detector)[0][0], 2 * c_d_s[0][0])
+
+        base_spectrum.baseCounts = original_counts
+        session.commit()
+
     # Can we run the replay tools and get results?
     def test_run_replay(self, qtbot):
         """Dependent on test_spec_gen running"""
@@ -690,6 +738,176 @@ class Test_Sampling:
             assert len(sc) == d.chan_count
         assert max(sum_rip) - min(sum_rip) < min_sqrt_rip
 
+    def test_rejection_sampling(self):
+        """
+        Verifies the rejection sampler draws exactly the Poisson-sampled number of counts,
+        and only into channels with non-zero probability
+        """
+        from src.sampling_algos import generate_sample_counts_rejection as s_rejection
+
+        class Scenario:
+            pass
+        class Detector:
+            pass
+
+        s = Scenario()
+        d = Detector()
+
+        s.acq_time = 60
+        d.chan_count = 512
+        seed = 3
+        counts = np.array([100.] * d.chan_count)
+        counts[:50] = 0
+        counts[200:210] = 5000
+        dose = .2
+        sensitivity = 9000
+
+        integral = np.random.default_rng(seed).poisson(s.acq_time * dose * sensitivity)
+
+        sample_counts = s_rejection(s, d, [(counts, dose, sensitivity)], seed)
+        assert len(sample_counts) == d.chan_count
+        assert sum(sample_counts) == integral
+        assert sum(sample_counts[:50]) == 0
+        assert sum(sample_counts[200:210]) > sum(sample_counts[210:220])
+
+    def test_gaussian_smearing(self):
+        """
+        Verifies integer spectra are redistributed count by count, and floating point spectra
+        are replaced by their expected smeared values
+        """
+        from src.rase_functions import smearing_matrix
+
+        n = 256
+        counts = np.zeros(n, dtype=int)
+        counts[100] = 20000
+        bin_widths = np.full(n, 2.)
+        rng = np.random.default_rng(8)
+
+        kernel = smearing_matrix(bin_widths, 5)
+        assert np.isclose(kernel[:, 100].sum(), 1)
+
+        smeared = gaussian_smearing(counts, bin_widths, 5, rng=rng)
+        assert smeared.sum() == counts.sum()
+        # counts are smeared around channel 100 with a width of 2 + 0.05 / 2.355 * 100 ~ 4.1 channels
+        assert abs(np.average(np.arange(n) + 0.5, weights=smeared) - 100) < 0.2
+        assert 3.8 < np.sqrt(np.cov(np.arange(n) + 0.5, fweights=smeared)) < 4.4
+
+        expected = gaussian_smearing(counts * 0.5, bin_widths, 5, is_float=True)
+        assert np.allclose(expected, kernel @ (counts * 0.5))
+
+        # many counts are drawn with conditional binomials instead
+        counts[:] = 1000
+        smeared = gaussian_smearing(counts, bin_widths, 5, rng=rng)
+        assert smeared[20:-20].sum() == pytest.approx(counts[20:-20].sum(), rel=0.01)
+
+    def test_batch_sampling(self):
+        """
+        Verifies that each row of a batch of replications matches the single-replication sampler
+        with the random stream of that replication
+        """
+        from src.sampling_algos import generate_sample_counts_rejection as s_rejection
+        from src.sampling_algos import generate_sample_counts_inversion as s_inversion
+        from src.sampling_algos import generate_sample_counts_poisson as s_poisson
+        from src.sampling_algos import sample_counts_batch, sample_seed_sequence, replication_rng
+
+        class Scenario:
+            pass
+        class Detector:
+            pass
+
+        s = Scenario()
+        d = Detector()
+
+        s.acq_time = 30
+        d.chan_count = 256
+        seed_sequence = sample_seed_sequence(11, 'det', 1)
+        counts_1 = np.linspace(0., 500., d.chan_count)
+        counts_2 = np.array([40.] * d.chan_count)
+        c_d_s = [(counts_1, .1, 2000), (counts_2, .05, 800)]
+
+        for algo in [s_rejection, s_inversion, s_poisson]:
+            batch = sample_counts_batch(algo, s, d, c_d_s, seed_sequence, 4, first=2)
+            assert batch.shape == (4, d.chan_count)
+            for i, sample_counts in enumerate(batch):
+                assert np.array_equal(sample_counts, algo(s, d, c_d_s, replication_rng(seed_sequence, 2 + i)))
+            # other detector/scenario pairs with the same seed get different streams
+            other = sample_counts_batch(algo, s, d, c_d_s, sample_seed_sequence(11, 'det', 2), 4, first=2)
+            assert not np.array_equal(batch, other)
+
+class Test_Distortions:
+    def test_rebin(self):
+        """
+        Verifies rebinning preserves counts within the common energy range, is the identity for identical
+        calibrations, and that the cached rebin matrix gives the same result
+        """
+        from src.rase_functions import rebin_matrix
+
+        n = 512
+        counts = np.random.default_rng(5).poisson(100, n).astype(float)
+        old_ecal = (0., 3., 0., 0.)
+        new_ecal = (-1.5, 3.1, 1e-5, 0.)
+        old_energies = np.polyval(np.flip(old_ecal), np.arange(n))
+
+        # the last channel has no upper energy boundary and is not distributed
+        assert np.allclose(rebin(counts, old_energies, old_ecal)[:-1], counts[:-1])
+
+        # the new calibration covers the whole old energy range
+        new_counts = rebin(counts, old_energies, new_ecal)
+        assert np.isclose(new_counts.sum(), counts[:-1].sum())
+        assert np.allclose(rebin_matrix(old_ecal, new_ecal, n) @ counts, new_counts)
+        assert rebin_matrix(old_ecal, new_ecal, n) is rebin_matrix(old_ecal, new_ecal, n)
+
+
+    def test_n42_writer(self, tmp_path):
+        """Verifies the channel data written by the n42 writer, with and without compression"""
+        class Scenario:
+            pass
+        class Detector:
+            pass
+
+        s = Scenario()
+        s.acq_time = 30
+        d = Detector()
+        d.ecal0, d.ecal1, d.ecal2, d.ecal3 = 0., 3., 0., 0.
+        counts = np.array([0, 0, 0, 0, 5, 3, 0, 1, 0, 0, 0, 0, 0])
+
+        for compressed in [False, True]:
+            fname = tmp_path / f'compressed_{compressed}.n42'
+            N42Writer(s, d, compressed=compressed).write(fname, counts)
+            channel_data = etree.parse(str(fname)).find('.//ChannelData')
+            values = [float(c) for c in channel_data.text.split()]
+            assert len(values) == (9 if compressed else len(counts))
+            uncompressed = uncompressCountedZeroes(channel_data, values)
+            assert np.array_equal([float(c) for c in uncompressed.split(',')], counts)
+
+    def test_n42_template_renderer(self, tmp_path):
+        """Verifies that templates are compiled once and rendered with the variables they use"""
+        from mako.template import Template
+        from src.rase_functions import N42TemplateRenderer, get_n42_template, _template_identifiers
+
+        template_path = tmp_path / 'template.n42'
+        template_path.write_text('${sample_counts}|${compressed_sample_counts}|${detector}')
+        assert get_n42_template(str(template_path)) is get_n42_template(str(template_path))
+
+        counts = np.array([0, 0, 0, 2, 5, 0, 1])
+        renderer = N42TemplateRenderer(get_n42_template(str(template_path)), 'scen', 'det')
+        assert renderer.identifiers == {'sample_counts', 'compressed_sample_counts', 'detector'}
+        renderer.write(tmp_path / 'out.n42', counts)
+        assert (tmp_path / 'out.n42').read_text() == '0 0 0 2 5 0 1|0 3 2 5 0 1 1|det'
+
+        assert _template_identifiers(Template(text='${len(context.keys())}')) is None
+
+    def test_influence_bin_widths(self):
+        """Verifies the vectorized fixed smearing widths match the roots of the influence polynomial"""
+        from src.rase_functions import _max_quadratic_root
+
+        energies = np.linspace(0, 3000, 50)
+        for a, b, c in [(1e-5, 1.01, 2.), (-1e-5, 0.98, -1.), (0., 1.1, 0.5)]:
+            roots = _max_quadratic_root(a, b, c - energies)
+            assert np.allclose(roots, [max(np.roots([a, b, c - e]).real) for e in energies])
+        assert np.array_equal(_max_quadratic_root(0., 0., energies), np.zeros_like(energies))
+
+
 class Test_Import_Export:
     hoc = HelpObjectCreation()
     def test_export(self, qtbot):